@@ -0,0 +1,251 @@
+#
+# Performance benchmarks for the engine, with stored baselines to catch regressions.
+#
+# Usage: python Benchmark.py                        print results
+#        python Benchmark.py --save [baseline]      also write them to the baseline file
+#        python Benchmark.py --compare [baseline]   exit with status 1 if a metric regressed past --threshold
+#
+# Every metric is the best of --repeat runs, to keep timer noise out of the comparison.
+#
+import argparse
+import copy
+import json
+import os
+import pickle
+import sys
+import time
+
+try:  # bare names first, so test.py and these modules share one copy of each module
+    import Classes
+    import ChessAI
+except ImportError:  # imported as part of the Chess package from outside the Chess folder
+    from Chess import Classes, ChessAI
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+REGRESSION_THRESHOLD = 0.15  # fraction a metric may get worse by before --compare fails
+REPEAT = 3
+
+# (fen, perft depth)
+PERFT_POSITIONS = [("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", 3),
+                   ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 2),
+                   ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 3)]
+TACTICAL_POSITIONS = ["r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4",
+                      "1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1",
+                      "r1b1k2r/ppppnppp/2n2q2/2b5/3NP3/2P1B3/PP3PPP/RN1QKB1R w KQkq - 0 1",
+                      "r2q1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 9",
+                      "2r3k1/1q1nbppp/r3p3/3pP3/pPpP4/P1Q2N2/2RN1PPP/2R4K b - - 0 22",
+                      "r1bq1rk1/pp1nbppp/2p1pn2/3p4/2PP4/2NBPN2/PPQ2PPP/R1B1K2R w KQ - 0 8"]
+SEARCH_DEPTH = 2
+COPY_PLIES = 10  # moves played before copying, so deepcopy and pickle also carry a move log
+
+
+class Metric:
+    def __init__(self, value, unit, higher_is_better):
+        self.value = value
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+
+    def to_json(self):
+        return {"value": self.value, "unit": self.unit, "higher_is_better": self.higher_is_better}
+
+
+# Best time of repeat calls to function
+def get_best_time(function, repeat=REPEAT):
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        elapsed_time = time.perf_counter() - start_time
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+    return best_time
+
+
+def perft(gs, depth):
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in gs.get_valid_moves(gs.player_moving):
+        promoted = ChessAI.make_search_move(gs, move)
+        nodes += perft(gs, depth - 1)
+        ChessAI.undo_search_move(gs, move, promoted)
+    return nodes
+
+
+def bench_perft(repeat=REPEAT):
+    nodes = sum(perft(Classes.GameState(fen), depth) for fen, depth in PERFT_POSITIONS)
+    elapsed_time = get_best_time(lambda: [perft(Classes.GameState(fen), depth) for fen, depth in PERFT_POSITIONS], repeat)
+    return Metric(nodes / elapsed_time, "nodes/s", True)
+
+
+def bench_get_valid_moves(repeat=REPEAT, calls=20):
+    game_states = [Classes.GameState(fen) for fen in TACTICAL_POSITIONS]
+    elapsed_time = get_best_time(lambda: [gs.get_valid_moves(gs.player_moving) for gs in game_states for _ in range(calls)], repeat)
+    return Metric(len(game_states) * calls / elapsed_time, "calls/s", True)
+
+
+def bench_is_seen(repeat=REPEAT):
+    game_states = [Classes.GameState(fen) for fen in TACTICAL_POSITIONS]
+    calls = [(square, gs.player_moving, gs.board) for gs in game_states for row in gs.board for square in row]
+    elapsed_time = get_best_time(lambda: [square.is_seen(player, board) for square, player, board in calls], repeat)
+    return Metric(len(calls) / elapsed_time, "calls/s", True)
+
+
+def bench_search(repeat=REPEAT):
+    def search():
+        ChessAI.set_weights(dict(ChessAI.DEFAULT_WEIGHTS))  # same evaluation and an empty pawn table every run
+        stats = ChessAI.SearchStats()
+        for fen in TACTICAL_POSITIONS:
+            ChessAI.get_best_move(Classes.GameState(fen), SEARCH_DEPTH, stats=stats)
+        return stats
+
+    weights = ChessAI.weights
+    stats = search()
+    elapsed_time = get_best_time(search, repeat)
+    ChessAI.set_weights(weights)
+    return Metric((stats.nodes + stats.quiescence_nodes) / elapsed_time, "nodes/s", True)
+
+
+def bench_make_board(repeat=REPEAT, calls=100):
+    players = Classes.Players(Classes.Player(Classes.Color.White), Classes.Player(Classes.Color.Black))
+    elapsed_time = get_best_time(lambda: [Classes.make_board(players) for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+def bench_game_state(repeat=REPEAT, calls=100):
+    elapsed_time = get_best_time(lambda: [Classes.GameState() for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+# Game state a few moves into a game, with its valid moves cached, as analysis code would copy it
+def get_copy_game_state():
+    gs = Classes.GameState(TACTICAL_POSITIONS[-1])
+    for ply in range(COPY_PLIES):
+        ChessAI.make_search_move(gs, gs.get_valid_moves(gs.player_moving)[ply % 3])
+    gs.get_cached_valid_moves()
+    return gs
+
+
+def bench_snapshot(repeat=REPEAT, calls=1000):
+    gs = get_copy_game_state()
+    elapsed_time = get_best_time(lambda: [gs.snapshot() for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+def bench_clone(repeat=REPEAT, calls=100):
+    gs = get_copy_game_state()
+    elapsed_time = get_best_time(lambda: [gs.clone() for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+# What snapshot and clone replace, for comparison
+def bench_deepcopy(repeat=REPEAT, calls=100):
+    gs = get_copy_game_state()
+    elapsed_time = get_best_time(lambda: [copy.deepcopy(gs) for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+def bench_pickle(repeat=REPEAT, calls=100):
+    gs = get_copy_game_state()
+    elapsed_time = get_best_time(lambda: [pickle.loads(pickle.dumps(gs)) for _ in range(calls)], repeat)
+    return Metric(elapsed_time / calls * 1e6, "us", False)
+
+
+def bench_snapshot_size(repeat=REPEAT):
+    return Metric(len(get_copy_game_state().snapshot()), "bytes", False)
+
+
+def bench_pickle_size(repeat=REPEAT):
+    return Metric(len(pickle.dumps(get_copy_game_state())), "bytes", False)
+
+
+# draw_game_state on a dummy SDL display. None when pygame is not installed
+def bench_render(repeat=REPEAT, calls=50):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import pygame
+    except ImportError:
+        return None
+    try:
+        import main
+    except ImportError:
+        from Chess import main
+
+    pygame.init()
+    screen = pygame.display.set_mode((main.WIDTH, main.HEIGHT))
+    main.load_images()
+    gs = Classes.GameState(TACTICAL_POSITIONS[-1])
+    valid_moves = gs.get_valid_moves(gs.player_moving)
+    elapsed_time = get_best_time(lambda: [main.draw_game_state(screen, gs, valid_moves, None) for _ in range(calls)], repeat)
+    pygame.quit()
+    return Metric(elapsed_time / calls * 1e3, "ms", False)
+
+
+BENCHMARKS = {"perft": bench_perft,
+              "get_valid_moves": bench_get_valid_moves,
+              "is_seen": bench_is_seen,
+              "search": bench_search,
+              "make_board": bench_make_board,
+              "game_state": bench_game_state,
+              "snapshot": bench_snapshot,
+              "clone": bench_clone,
+              "deepcopy": bench_deepcopy,
+              "pickle": bench_pickle,
+              "snapshot_size": bench_snapshot_size,
+              "pickle_size": bench_pickle_size,
+              "render": bench_render}
+
+
+def run_benchmarks(repeat=REPEAT):
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        metric = benchmark(repeat)
+        if metric is not None:
+            results[name] = metric.to_json()
+    return results
+
+
+# Names of metrics that got worse than the baseline by more than threshold, with the fraction they got worse by
+def get_regressions(baseline, results, threshold=REGRESSION_THRESHOLD):
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_value = baseline[name]["value"]
+        if result["higher_is_better"]:
+            change = (baseline_value - result["value"]) / baseline_value
+        else:
+            change = (result["value"] - baseline_value) / baseline_value
+        if change > threshold:
+            regressions[name] = change
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the engine benchmarks.")
+    parser.add_argument("--save", nargs="?", const=BASELINE_FILE, help="write results as the new baseline")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_FILE, help="fail if results regressed against a baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat)
+    for name, result in results.items():
+        print(name.ljust(16) + str(round(result["value"], 1)).rjust(12) + " " + result["unit"])
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print("wrote " + args.save)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = get_regressions(json.load(baseline_file), results, args.threshold)
+        for name, change in regressions.items():
+            print(name + " regressed by " + str(round(change * 100)) + "%")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,317 @@
+#
+# Move selection for the computer player.
+#
+import json
+import os
 import random
 
+try:  # bare names first, so test.py and these modules share one copy of each module
+    import Classes
+except ImportError:  # imported as part of the Chess package from outside the Chess folder
+    from Chess import Classes
+
+MATE_SCORE = 1000
+SEE_KING_VALUE = 100  # king only joins an exchange last
+PROMOTION_GAIN = Classes.typeToValue[Classes.PieceType.Queen] - Classes.typeToValue[Classes.PieceType.Pawn]
+
+PAWN_TABLE_SIZE = 4096
+
+# Evaluation weights in pawns. Tuner.py writes tuned values to WEIGHTS_FILE, which is loaded at startup
+MATERIAL_FEATURES = ["Queen", "Rook", "Bishop", "Knight", "Pawn"]
+PAWN_FEATURES = ["doubled_pawn", "isolated_pawn", "passed_pawn"]
+DEFAULT_WEIGHTS = {"Queen": 9,
+                   "Rook": 5,
+                   "Bishop": 3,
+                   "Knight": 3,
+                   "Pawn": 1,
+                   "doubled_pawn": -0.25,  # per extra pawn on a file
+                   "isolated_pawn": -0.25,
+                   "passed_pawn": 0.5}
+WEIGHTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights.json")
+
+
+class SearchStats:
+    def __init__(self):
+        self.nodes = 0
+        self.quiescence_nodes = 0
+
 
 def get_random_move(valid_moves):
     return valid_moves[random.randint(0, len(valid_moves) - 1)]
+
+
+# Fixed size table of pawn structure scores, indexed by pawn hash
+class PawnHashTable:
+    def __init__(self, size=PAWN_TABLE_SIZE):
+        self.size = size
+        self.keys = [None] * size
+        self.scores = [0] * size
+        self.hits = 0
+        self.misses = 0
+
+    def get_score(self, gs):
+        pawn_hash = gs.pawn_hash_history[-1]
+        index = pawn_hash % self.size
+        if self.keys[index] == pawn_hash:
+            self.hits += 1
+            return self.scores[index]
+        self.misses += 1
+        self.keys[index] = pawn_hash
+        self.scores[index] = evaluate_pawn_structure(gs)
+        return self.scores[index]
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+def load_weights(path=WEIGHTS_FILE):
+    weights = dict(DEFAULT_WEIGHTS)
+    if os.path.exists(path):
+        with open(path) as weights_file:
+            weights.update(json.load(weights_file))
+    return weights
+
+
+def set_weights(new_weights):
+    global weights, piece_values, pawn_table
+    weights = new_weights
+    piece_values = {Classes.typeToClass[Classes.PieceType[name]]: weights[name] for name in MATERIAL_FEATURES}
+    piece_values[Classes.King] = 0
+    pawn_table = PawnHashTable()  # cached scores used the old weights
+
+
+# Doubled, isolated and passed pawn counts, White's minus Black's
+def get_pawn_structure_counts(gs):
+    pawn_squares = {}
+    for player in gs.players:
+        pawn_squares[player.color] = [(piece.square.row, piece.square.column) for piece in player.piece_list if isinstance(piece, Classes.Pawn)]
+
+    counts = {name: 0 for name in PAWN_FEATURES}
+    for color, sign in [(Classes.Color.White, 1), (Classes.Color.Black, -1)]:
+        own_pawns = pawn_squares[color]
+        enemy_pawns = pawn_squares[Classes.Color(1 - color.value)]
+        pawn_files = [column for row, column in own_pawns]
+        for file in set(pawn_files):
+            counts["doubled_pawn"] += sign * (pawn_files.count(file) - 1)
+        for row, column in own_pawns:
+            if column - 1 not in pawn_files and column + 1 not in pawn_files:
+                counts["isolated_pawn"] += sign
+            # White pawns move towards row 0, so pawns ahead of a white pawn have a smaller row
+            if not any(abs(enemy_column - column) <= 1 and (enemy_row - row) * sign < 0 for enemy_row, enemy_column in enemy_pawns):
+                counts["passed_pawn"] += sign
+    return counts
+
+
+# Pawn structure score from White's point of view
+def evaluate_pawn_structure(gs):
+    counts = get_pawn_structure_counts(gs)
+    return sum(weights[name] * counts[name] for name in PAWN_FEATURES)
+
+
+# Material and pawn structure from the point of view of the player moving
+def evaluate(gs):
+    pawn_score = pawn_table.get_score(gs)
+    if gs.player_moving.color == Classes.Color.Black:
+        pawn_score = -pawn_score
+    return sum(piece_values[type(piece)] for piece in gs.player_moving.piece_list) - \
+           sum(piece_values[type(piece)] for piece in gs.player_waiting.piece_list) + pawn_score
+
+
+set_weights(load_weights())
+
+
+# Makes a move during search, including promotion and turn. Returns state for undo_search_move
+def make_search_move(gs, move):
+    gs.make_move(move)
+    promoted = gs.can_promote_pawn(move)
+    if promoted:
+        gs.promote_pawn(gs.player_moving, move, True)
+    gs.toggle_turn()
+    return promoted
+
+
+def undo_search_move(gs, move, promoted):
+    gs.toggle_turn()
+    if promoted:
+        gs.player_moving.piece_list.remove(move.end_square.piece)
+        gs.player_moving.piece_list.append(move.piece_moving)
+        move.end_square.update_piece(move.piece_moving)
+    gs.undo_move()
+
+
+def is_tactical(move):
+    return move.pieceCaptured is not None or Classes.GameState.can_promote_pawn(move)
+
+
+def get_see_value(piece):
+    if isinstance(piece, Classes.King):
+        return SEE_KING_VALUE
+    return piece.material_value
+
+
+# Pieces on every line through the square, nearest first, so x-ray attackers join once the front piece is gone
+def get_attackers(board, square):
+    rays = []
+    knights = []
+    knight_directions = Classes.Direction.get_knight_directions()
+    for direction in Classes.Direction:
+        inverse_direction = Classes.Direction.get_inverse_direction(direction)
+        row = square.row + direction.value[0]
+        column = square.column + direction.value[1]
+        distance = 1
+        ray = []
+        while row in range(Classes.ROW_SIZE) and column in range(Classes.COLUMN_SIZE):
+            piece = board[row][column].piece
+            if piece:
+                can_attack = distance <= piece.max_move_distance and inverse_direction in piece.sees_directions
+                if direction in knight_directions:
+                    if can_attack:
+                        knights.append(piece)
+                else:
+                    ray.append([piece, can_attack])
+            if direction in knight_directions:
+                break
+            row += direction.value[0]
+            column += direction.value[1]
+            distance += 1
+        if ray:
+            rays.append(ray)
+    return rays, knights
+
+
+def remove_attacker(rays, knights, piece):
+    for ray in rays:
+        for entry in ray:
+            if entry[0] is piece:
+                ray.remove(entry)
+                return
+    if piece in knights:
+        knights.remove(piece)
+
+
+def pop_least_valuable_attacker(rays, knights, color):
+    best_piece = None
+    best_source = None
+    for ray in rays:
+        if ray and ray[0][1] and ray[0][0].color == color:
+            if best_piece is None or get_see_value(ray[0][0]) < get_see_value(best_piece):
+                best_piece, best_source = ray[0][0], ray
+    for knight in knights:
+        if knight.color == color and (best_piece is None or get_see_value(knight) < get_see_value(best_piece)):
+            best_piece, best_source = knight, knights
+    if best_piece is not None:
+        if best_source is knights:
+            knights.remove(best_piece)
+        else:
+            best_source.pop(0)
+    return best_piece
+
+
+# Static exchange evaluation: material won by the side making the move after the full capture sequence
+# on its end square, worked out from the attacker sets without making any moves
+def static_exchange_evaluation(gs, move):
+    rays, knights = get_attackers(gs.board, move.end_square)
+    remove_attacker(rays, knights, move.piece_moving)
+    if move.pieceCaptured and move.pieceCaptured.square is not move.end_square:  # en passant
+        remove_attacker(rays, knights, move.pieceCaptured)
+
+    gain = [move.pieceCaptured.material_value if move.pieceCaptured else 0]
+    on_square_value = get_see_value(move.piece_moving)
+    if Classes.GameState.can_promote_pawn(move):
+        gain[0] += PROMOTION_GAIN
+        on_square_value = Classes.typeToValue[Classes.PieceType.Queen]
+
+    color = Classes.Color(1 - move.piece_moving.color.value)
+    while True:
+        attacker = pop_least_valuable_attacker(rays, knights, color)
+        if attacker is None:
+            break
+        gain.append(on_square_value - gain[-1])
+        on_square_value = get_see_value(attacker)
+        color = Classes.Color(1 - color.value)
+
+    for depth in range(len(gain) - 1, 0, -1):
+        gain[depth - 1] = -max(-gain[depth - 1], gain[depth])
+    return gain[0]
+
+
+def get_mvv_lva(move):
+    return (move.pieceCaptured.material_value if move.pieceCaptured else PROMOTION_GAIN) * 10 - get_see_value(move.piece_moving)
+
+
+# Captures and promotions for the player moving, best first. Losing captures are dropped when use_see is set
+def get_tactical_moves(gs, use_see=True):
+    moves = [move for move in gs.add_possible_moves(gs.player_moving) if is_tactical(move)]
+    if not use_see:
+        return sorted(moves, key=get_mvv_lva, reverse=True)
+    scored_moves = [(static_exchange_evaluation(gs, move), move) for move in moves]
+    return [move for score, move in sorted(scored_moves, key=lambda x: x[0], reverse=True) if score >= 0]
+
+
+# Searches captures and promotions until the position is quiet
+def quiescence(gs, alpha, beta, stats, use_see=True):
+    stats.quiescence_nodes += 1
+    best_score = evaluate(gs)
+    if best_score >= beta:
+        return best_score
+    alpha = max(alpha, best_score)
+
+    for move in get_tactical_moves(gs, use_see):
+        undo_state = make_search_move(gs, move)
+        if gs.player_waiting.is_in_check(gs.board):  # pseudo-legal move left the king in check
+            undo_search_move(gs, move, undo_state)
+            continue
+        score = -quiescence(gs, -beta, -alpha, stats, use_see)
+        undo_search_move(gs, move, undo_state)
+
+        if score > best_score:
+            best_score = score
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+    return best_score
+
+
+def negamax(gs, depth, alpha, beta, stats, use_see=True, ply=0):
+    if gs.get_repetition_count() >= 1 or gs.is_fifty_move_draw():  # a repeated position is treated as a draw
+        return 0
+    if depth == 0:
+        if not gs.has_legal_move(gs.player_moving):
+            return -MATE_SCORE + ply if gs.player_moving.is_in_check(gs.board) else 0
+        return quiescence(gs, alpha, beta, stats, use_see)
+    stats.nodes += 1
+
+    valid_moves = gs.get_cached_valid_moves()
+    if len(valid_moves) == 0:
+        return -MATE_SCORE + ply if gs.player_moving.is_in_check(gs.board) else 0
+
+    best_score = -MATE_SCORE
+    for move in sorted(valid_moves, key=lambda m: get_mvv_lva(m) if is_tactical(m) else -MATE_SCORE, reverse=True):
+        undo_state = make_search_move(gs, move)
+        score = -negamax(gs, depth - 1, -beta, -alpha, stats, use_see, ply + 1)
+        undo_search_move(gs, move, undo_state)
+
+        if score > best_score:
+            best_score = score
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+    return best_score
+
+
+# Returns the best move for the player moving and its score, searched to depth plies plus quiescence
+def get_best_move(gs, depth=2, use_see=True, stats=None):
+    stats = stats if stats else SearchStats()
+    stats.nodes += 1
+    alpha = -MATE_SCORE - 1
+    best_move = None
+    for move in gs.get_cached_valid_moves():
+        undo_state = make_search_move(gs, move)
+        score = -negamax(gs, depth - 1, -MATE_SCORE - 1, -alpha, stats, use_see, 1)
+        undo_search_move(gs, move, undo_state)
+        if best_move is None or score > alpha:
+            best_move, alpha = move, score
+    return best_move, alpha
@@ -1,9 +1,10 @@
 #
 # Classes needed for chess game.
 #
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from enum import Enum
 import random
+import struct
 
 ROW_SIZE = 8
 COLUMN_SIZE = 8
@@ -87,10 +88,41 @@ typeToValue = {PieceType.King: 0,
                PieceType.Pawn: 1}
 
 
+pieceNames = [("w" if color == Color.White else "b") + typeToAbv[piece_type] for color in Color for piece_type in PieceType]
+nameToCode = {name: code for code, name in enumerate(pieceNames, 1)}  # 0 is an empty square
+codeToName = {v: k for k, v in nameToCode.items()}
+
+# (color, rook column) of each castling right, in snapshot bit order
+castleRights = [(Color.White, 7), (Color.White, 0), (Color.Black, 7), (Color.Black, 0)]
+fenToCastleRight = {"K": castleRights[0], "Q": castleRights[1], "k": castleRights[2], "q": castleRights[3]}
+
+# Snapshot layout, packed little-endian in 71 bytes: 64 piece codes, side to move, castling right bits,
+# en passant column (-1 for none), ply, halfmove clock
+SNAPSHOT_FORMAT = struct.Struct("<64sBBbHH")
+
+# Random keys for Zobrist position hashing
+zobristRandom = random.Random(0)
+zobristPieceKeys = {(name, row, column): zobristRandom.getrandbits(64)
+                    for name in pieceNames for row in range(ROW_SIZE) for column in range(COLUMN_SIZE)}
+zobristCastleKeys = {right: zobristRandom.getrandbits(64) for right in castleRights}
+zobristEnPassantKeys = {column: zobristRandom.getrandbits(64) for column in range(COLUMN_SIZE)}
+zobristBlackToMoveKey = zobristRandom.getrandbits(64)
+
+MOVE_CACHE_SIZE = 1024
+
+
+def get_piece_key(piece, square):
+    return zobristPieceKeys[(piece.nameAbv, square.row, square.column)]
+
+
 def get_rank_file(row, column):
     return columnToFile[column] + rowToRank[row]
 
 
+def get_row_column(rank_file):
+    return rankToRow[rank_file[1]], fileToColumn[rank_file[0]]
+
+
 class Player:
     def __init__(self, color):
         self.color = color
@@ -107,6 +139,9 @@ class Player:
         return self.king.square.is_seen(self, board)
 
 
+Players = namedtuple('Players', ['white', 'black'])
+
+
 class Piece:
     def __init__(self, player, square):
         self.square = square
@@ -218,6 +253,19 @@ class King(Piece):
         self.castle_move_distance = 2
 
 
+typeToClass = {PieceType.King: King,
+               PieceType.Queen: Queen,
+               PieceType.Rook: Rook,
+               PieceType.Bishop: Bishop,
+               PieceType.Knight: Knight,
+               PieceType.Pawn: Pawn}
+
+# Order pieces are tried in when looking for a valid move, cheapest first
+generationOrder = {King: 0,
+                   Knight: 1,
+                   Pawn: 2}
+
+
 class Square:
     def __init__(self, row, column, color, piece):
         self.row = row
@@ -289,6 +337,8 @@ class Move:
                         return True
                     else:
                         return False
+                else:
+                    return False
         if self.end_square.piece:
             if self.end_square.piece.color != self.piece_moving.color:
                 return True
@@ -318,6 +368,51 @@ class EnPassant(Move):
         self.pieceCaptured = self.board[self.start_square.row][self.end_square.column].piece
 
 
+# Valid moves for one position, indexed by (start square, end square)
+class ValidMoves(list):
+    def __init__(self, moves):
+        super().__init__(moves)
+        self.index = {(move.start_square, move.end_square): move for move in moves}
+
+    def get_move(self, start_square, end_square):
+        return self.index.get((start_square, end_square))
+
+    # False when the squares now hold different piece objects, e.g. a new queen after promoting again
+    def matches_board(self):
+        for move in self:
+            if move.start_square.piece is not move.piece_moving:
+                return False
+            if not isinstance(move, EnPassant) and move.end_square.piece is not move.pieceCaptured:
+                return False
+            if isinstance(move, Castle) and move.rook_move.start_square.piece is not move.rook:
+                return False
+        return True
+
+
+# Least recently used cache of ValidMoves keyed by position hash
+class MoveCache:
+    def __init__(self, max_size=MOVE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        valid_moves = self.entries.get(key)
+        if valid_moves is None or not valid_moves.matches_board():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return valid_moves
+
+    def put(self, key, valid_moves):
+        self.entries[key] = valid_moves
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
 def make_board(players):
     the_board = [[Square(0, 0, None, None) for _ in range(0, 8)] for _ in range(0, 8)]
     temp_player = players.black  # Used for populating with pieces.
@@ -356,18 +451,166 @@ def make_board(players):
     return the_board
 
 
+# Builds board from 64 snapshot piece codes and the castling rights still available
+def make_board_from_codes(players, piece_codes, castling_rights):
+    the_board = [[None for _ in range(COLUMN_SIZE)] for _ in range(ROW_SIZE)]
+    for row in range(ROW_SIZE):
+        for column in range(COLUMN_SIZE):
+            temp_square = Square(row, column, Color((row + column) % 2), None)
+            the_board[row][column] = temp_square
+            code = piece_codes[row * COLUMN_SIZE + column]
+            if code == 0:
+                continue
+
+            name = codeToName[code]
+            temp_player = players.white if name[0] == "w" else players.black
+            temp_piece = typeToClass[abvToType[name[1]]](temp_player, temp_square)
+            match temp_piece:
+                case Pawn():
+                    temp_piece.has_moved = row != temp_player.back_row + (-1 if temp_player.color == Color.White else 1)
+                case King() | Rook():
+                    temp_piece.has_moved = True  # cleared below by castling rights
+            temp_player.piece_list.append(temp_piece)
+            if isinstance(temp_piece, King):
+                temp_player.king = temp_piece
+            temp_square.piece = temp_piece
+
+    for color, column in castling_rights:
+        temp_player = players.white if color == Color.White else players.black
+        temp_rook = the_board[temp_player.back_row][column].piece
+        if isinstance(temp_rook, Rook) and temp_player.king.square.row == temp_player.back_row and temp_player.king.square.column == 4:
+            temp_rook.has_moved = temp_player.king.has_moved = False
+
+    return the_board
+
+
+def get_snapshot_from_fen(fen):
+    fields = fen.split() + ["w", "-", "-", "0", "1"][len(fen.split()) - 1:]
+    piece_codes = []
+    for char in fields[0].replace("/", ""):
+        if char.isdigit():
+            piece_codes += [0] * int(char)
+        else:
+            piece_codes.append(nameToCode[("w" if char.isupper() else "b") + ("p" if char in "pP" else char.upper())])
+    castling_bits = sum(1 << castleRights.index(fenToCastleRight[right]) for right in fields[2] if right in fenToCastleRight)
+    en_passant_column = fileToColumn[fields[3][0]] if fields[3] != "-" else -1
+    ply = (int(fields[5]) - 1) * 2 + (1 if fields[1] == "b" else 0)
+    return SNAPSHOT_FORMAT.pack(bytes(piece_codes), 1 if fields[1] == "b" else 0, castling_bits, en_passant_column, ply, int(fields[4]))
+
+
 class GameState:
-    # Create game state, players
-    def __init__(self):
+    # Create game state, players. Starts from a FEN string or a snapshot when given one
+    def __init__(self, fen=None, snapshot=None):
         self.checkmate = False
         self.stalemate = False
-        self.players = namedtuple('Players', ['white', 'black'])
-        self.players.white = Player(Color.White)
-        self.players.black = Player(Color.Black)
+        self.draw = False
+        self.move_cache = MoveCache()
+        if fen:
+            snapshot = get_snapshot_from_fen(fen)
+        if snapshot:
+            self.restore(snapshot)
+        else:
+            self.reset_players()
+            self.board = make_board(self.players)
+            self.moveLog = []
+            self.en_passant_column = None
+            self.start_ply = 0
+            self.start_history(0)
+
+    def reset_players(self):
+        self.players = Players(Player(Color.White), Player(Color.Black))
         self.player_moving = self.players.white
         self.player_waiting = self.players.black
-        self.board = make_board(self.players)
+
+    # Fixed size bytes encoding of the position. Move history is not kept
+    def snapshot(self):
+        piece_codes = bytes(nameToCode[square.piece.nameAbv] if square.piece else 0 for row in self.board for square in row)
+        castling_rights = self.get_castling_rights()
+        castling_bits = sum(1 << bit for bit, right in enumerate(castleRights) if right in castling_rights)
+        en_passant_column = self.get_en_passant_column()
+        return SNAPSHOT_FORMAT.pack(piece_codes, self.player_moving.color.value, castling_bits,
+                                    -1 if en_passant_column is None else en_passant_column, self.get_ply(), self.halfmove_clocks[-1])
+
+    def restore(self, snapshot):
+        piece_codes, black_to_move, castling_bits, en_passant_column, ply, halfmove_clock = SNAPSHOT_FORMAT.unpack(snapshot)
+        self.checkmate = False
+        self.stalemate = False
+        self.draw = False
+        self.reset_players()
+        self.board = make_board_from_codes(self.players, piece_codes,
+                                           [right for bit, right in enumerate(castleRights) if castling_bits & (1 << bit)])
+        if black_to_move:
+            self.toggle_turn()
         self.moveLog = []
+        self.move_cache.entries.clear()  # cached moves point at the old board
+        self.en_passant_column = None if en_passant_column == -1 else en_passant_column
+        self.start_ply = ply
+        self.start_history(halfmove_clock)
+
+    # Stacks kept in step with moveLog by make_move and undo_move
+    def start_history(self, halfmove_clock):
+        self.hash_history = [self.get_position_hash()]
+        self.pawn_hash_history = [self.get_pawn_hash()]
+        self.halfmove_clocks = [halfmove_clock]
+        self.had_moved_history = []
+
+    def clone(self):
+        return GameState(snapshot=self.snapshot())
+
+    def get_ply(self):
+        return self.start_ply + len(self.moveLog)
+
+    # (color, rook column) of every castling right that has not been lost
+    def get_castling_rights(self):
+        castling_rights = []
+        for color, column in castleRights:
+            player = self.players.white if color == Color.White else self.players.black
+            temp_rook = self.board[player.back_row][column].piece
+            if not player.king.has_moved and isinstance(temp_rook, Rook) and temp_rook.color == color and not temp_rook.has_moved:
+                castling_rights.append((color, column))
+        return castling_rights
+
+    # Zobrist hash of the pawns only, for caching pawn structure evaluation
+    def get_pawn_hash(self):
+        pawn_hash = 0
+        for player in self.players:
+            for piece in player.piece_list:
+                if isinstance(piece, Pawn):
+                    pawn_hash ^= get_piece_key(piece, piece.square)
+        return pawn_hash
+
+    def get_castling_hash(self):
+        castling_hash = 0
+        for right in self.get_castling_rights():
+            castling_hash ^= zobristCastleKeys[right]
+        return castling_hash
+
+    # Column of a pawn that just moved two squares and can be taken en passant
+    def get_en_passant_column(self):
+        if len(self.moveLog) == 0:
+            return self.en_passant_column
+        previous_move = self.moveLog[-1]
+        if isinstance(previous_move.piece_moving, Pawn) and abs(previous_move.start_square.row - previous_move.end_square.row) == 2:
+            return previous_move.end_square.column
+        return None
+
+    # Zobrist hash of piece placement, side to move, castling rights and en passant file
+    def get_position_hash(self):
+        position_hash = 0
+        for row in self.board:
+            for square in row:
+                if square.piece:
+                    position_hash ^= zobristPieceKeys[(square.piece.nameAbv, square.row, square.column)]
+
+        if self.player_moving.color == Color.Black:
+            position_hash ^= zobristBlackToMoveKey
+
+        position_hash ^= self.get_castling_hash()
+
+        en_passant_column = self.get_en_passant_column()
+        if en_passant_column is not None:
+            position_hash ^= zobristEnPassantKeys[en_passant_column]
+        return position_hash
 
     def toggle_turn(self):
         temp_player = self.player_moving
@@ -375,30 +618,71 @@ class GameState:
         self.player_waiting = temp_player
 
     def make_move(self, move):
+        # hash of the position after the move, with the other player to move
+        position_hash = self.hash_history[-1] ^ zobristBlackToMoveKey
+        changes_castling = (isinstance(move.piece_moving, (King, Rook)) and not move.piece_moving.has_moved) or \
+                           (isinstance(move.pieceCaptured, Rook) and not move.pieceCaptured.has_moved)
+        if changes_castling:
+            position_hash ^= self.get_castling_hash()
+        en_passant_column = self.get_en_passant_column()
+        if en_passant_column is not None:
+            position_hash ^= zobristEnPassantKeys[en_passant_column]
+        moving_keys = get_piece_key(move.piece_moving, move.start_square) ^ get_piece_key(move.piece_moving, move.end_square)
+        position_hash ^= moving_keys
+        pawn_hash = self.pawn_hash_history[-1]
+        if isinstance(move.piece_moving, Pawn):
+            pawn_hash ^= moving_keys
+        if move.pieceCaptured:
+            captured_key = get_piece_key(move.pieceCaptured, move.pieceCaptured.square)
+            position_hash ^= captured_key
+            if isinstance(move.pieceCaptured, Pawn):
+                pawn_hash ^= captured_key
+
         if isinstance(move, Castle):
-            self.make_move(move.rook_move)
+            position_hash ^= get_piece_key(move.rook, move.rook_move.start_square) ^ get_piece_key(move.rook, move.rook_move.end_square)
+            move.rook_move.end_square.update_piece(move.rook)
+            move.rook_move.start_square.update_piece(None)
+            move.rook.has_moved = True
         elif isinstance(move, EnPassant):
             move.pieceCaptured.square.piece = None
 
         # updates the moved piece and start square
         move.end_square.update_piece(move.piece_moving)
         move.start_square.update_piece(None)
+        self.had_moved_history.append(move.piece_moving.has_moved)
+        move.piece_moving.has_moved = True
 
         if move.pieceCaptured:
             self.player_waiting.piece_list.remove(move.pieceCaptured)
 
         self.moveLog.append(move)
 
+        if changes_castling:
+            position_hash ^= self.get_castling_hash()
+        en_passant_column = self.get_en_passant_column()
+        if en_passant_column is not None:
+            position_hash ^= zobristEnPassantKeys[en_passant_column]
+        self.hash_history.append(position_hash)
+        self.pawn_hash_history.append(pawn_hash)
+
+        if isinstance(move.piece_moving, Pawn) or move.pieceCaptured:
+            self.halfmove_clocks.append(0)
+        else:
+            self.halfmove_clocks.append(self.halfmove_clocks[-1] + 1)
+
     def undo_move(self):
         if len(self.moveLog) != 0:
             move = self.moveLog.pop()
+            self.hash_history.pop()
+            self.pawn_hash_history.pop()
+            self.halfmove_clocks.pop()
             move.start_square.update_piece(move.piece_moving)
 
             if isinstance(move, Castle):
                 move.rook_move.start_square.update_piece(move.rook)
                 move.rook_move.end_square.update_piece(None)
                 move.rook.has_moved = False
-                move.piece_moving.has_moved = False
+            move.piece_moving.has_moved = self.had_moved_history.pop()
 
             if isinstance(move, EnPassant):
                 move.pieceCaptured.square.update_piece(move.pieceCaptured)
@@ -409,19 +693,42 @@ class GameState:
             if move.pieceCaptured:
                 self.player_waiting.piece_list.append(move.pieceCaptured)  # adds captured piece back to players list
 
-    def is_legal_castle(self, player, move):
-        if player.king.has_moved or move.rook.has_moved:
+    # Takes back the last move and gives the turn back to the player who made it. undo_move expects the
+    # player who made the move to be moving, so the turn is toggled first. False when there is nothing to undo
+    def undo_turn(self):
+        if len(self.moveLog) == 0:
             return False
+        self.toggle_turn()
+        self.undo_move()
+        return True
+
+    # Times the current position came up before with the same player to move. Only looks back to the
+    # last capture or pawn move, since no earlier position can come up again
+    def get_repetition_count(self):
+        repetition_count = 0
+        oldest_index = max(0, len(self.hash_history) - 1 - self.halfmove_clocks[-1])
+        for index in range(len(self.hash_history) - 3, oldest_index - 1, -2):
+            if self.hash_history[index] == self.hash_history[-1]:
+                repetition_count += 1
+        return repetition_count
+
+    def is_threefold_repetition(self):
+        return self.get_repetition_count() >= 2
+
+    def is_fifty_move_draw(self):
+        return self.halfmove_clocks[-1] >= 100
+
+    # Called with the castle made. add_castle_moves has already checked the king and rook have not moved
+    def is_legal_castle(self, player, move):
+        if move.end_square.column == 6:
+            side = [4, 5, 6]  # King's Side
         else:
-            if move.end_square.column == 6:
-                side = [4, 5, 6]  # King's Side
-            else:
-                side = [4, 3, 2]  # Queen's Side
+            side = [4, 3, 2]  # Queen's Side
 
-            for x in range(3):
-                if self.board[player.back_row][side[x]].is_seen(player, self.board):
-                    return False
-            return True
+        for x in range(3):
+            if self.board[player.back_row][side[x]].is_seen(player, self.board):
+                return False
+        return True
 
     @staticmethod
     def can_promote_pawn(move):
@@ -430,8 +737,7 @@ class GameState:
                 return True
         return False
 
-    @staticmethod
-    def promote_pawn(player, move, is_ai):
+    def promote_pawn(self, player, move, is_ai):
         promotion_square = move.end_square
         '''
         if is_ai:
@@ -452,47 +758,82 @@ class GameState:
         new_piece.has_moved = True
         promotion_square.piece = new_piece
         player.piece_list.append(new_piece)
+        self.hash_history[-1] ^= get_piece_key(move.piece_moving, promotion_square) ^ get_piece_key(new_piece, promotion_square)
+        self.pawn_hash_history[-1] ^= get_piece_key(move.piece_moving, promotion_square)
+
+    # Makes and undoes a pseudo-legal move to check it does not leave the player's king in check
+    def is_legal_move(self, player, move):
+        self.make_move(move)
+        match move:
+            case Castle():
+                is_legal = self.is_legal_castle(player, move)
+            case _:
+                is_legal = not player.is_in_check(self.board)
+        self.undo_move()
+        return is_legal
 
     def get_valid_moves(self, player):
         possible_moves = self.add_possible_moves(player)
         invalid_moves = []
 
         for move in possible_moves:
-            self.make_move(move)
-            match move:
-                case Castle():
-                    if not self.is_legal_castle(player, move):
-                        invalid_moves.append(move)
-                case EnPassant():
-                    if player.is_in_check(self.board):
-                        invalid_moves.append(move)
-                case Move():
-                    if player.is_in_check(self.board):
-                        invalid_moves.append(move)
-            self.undo_move()
+            if not self.is_legal_move(player, move):
+                invalid_moves.append(move)
 
         for move in invalid_moves:
             possible_moves.remove(move)
         return possible_moves
 
+    # Valid moves for the player moving, reused when the same position comes up again
+    def get_cached_valid_moves(self):
+        position_hash = self.hash_history[-1]
+        valid_moves = self.move_cache.get(position_hash)
+        if valid_moves is None:
+            valid_moves = ValidMoves(self.get_valid_moves(self.player_moving))
+            self.move_cache.put(position_hash, valid_moves)
+        return valid_moves
+
+    # Yields valid moves one at a time: king moves first, then knights and pawns, sliders, and castling last.
+    # The board must be back in the same position each time the next move is requested.
+    def generate_valid_moves(self, player):
+        for piece in sorted(player.piece_list, key=lambda x: generationOrder.get(type(x), len(generationOrder))):
+            moves = []
+            self.add_piece_moves(piece, moves, False)
+            for move in moves:
+                if self.is_legal_move(player, move):
+                    yield move
+
+        castle_moves = []
+        self.add_castle_moves(player.king, castle_moves)
+        for move in castle_moves:
+            if self.is_legal_move(player, move):
+                yield move
+
+    # Checkmate/stalemate test that stops at the first valid move
+    def has_legal_move(self, player):
+        return next(self.generate_valid_moves(player), None) is not None
+
     def add_possible_moves(self, player):
         moves = []
         for piece in player.piece_list:
-            if isinstance(piece, King):
-                self.add_castle_moves(piece, moves)
-            if isinstance(piece, Pawn):
-                self.add_pawn_moves(piece, moves)
-            for direction in piece.move_directions:
-                for distance in range(1, 8):
-                    potential_move = Move(piece, direction, distance, self.board)
-                    if potential_move.is_possible:
-                        moves.append(potential_move)
-                        if potential_move.pieceCaptured or isinstance(piece, Knight):
-                            break
-                    else:
-                        break
+            self.add_piece_moves(piece, moves)
         return moves
 
+    def add_piece_moves(self, piece, moves, include_castles=True):
+        if isinstance(piece, King) and include_castles:
+            self.add_castle_moves(piece, moves)
+        if isinstance(piece, Pawn):
+            self.add_pawn_moves(piece, moves)
+        for direction in piece.move_directions:
+            for distance in range(1, piece.max_move_distance + 1):
+                potential_move = Move(piece, direction, distance, self.board)
+                if potential_move.is_possible:
+                    moves.append(potential_move)
+                    if potential_move.pieceCaptured or isinstance(piece, Knight):
+                        break
+                else:
+                    break
+
     def add_castle_moves(self, piece_to_move, moves):
         if not piece_to_move.has_moved:
             rook_col = [7, 0]
@@ -534,17 +875,20 @@ class GameState:
     def get_enpassant(self, pawn, moves):
         left = -1
         right = 1
+        en_passant_column = self.get_en_passant_column()
+        if en_passant_column is None:
+            return
         if (pawn.color == Color.White and pawn.square.row == 3) or (pawn.color == Color.Black and pawn.square.row == 4):
-            previous_move = self.moveLog[len(self.moveLog) - 1]
-            if isinstance(previous_move.piece_moving, Pawn):
-                if abs(previous_move.start_square.row - previous_move.end_square.row) == 2:
-                    if pawn.square.column == 0:
-                        self.add_ep(pawn, previous_move.piece_moving, right, moves)
-                    elif pawn.square.column == 7:
-                        self.add_ep(pawn, previous_move.piece_moving, left, moves)
-                    else:
-                        self.add_ep(pawn, previous_move.piece_moving, right, moves)
-                        self.add_ep(pawn, previous_move.piece_moving, left, moves)
+            opponent_pawn = self.board[pawn.square.row][en_passant_column].piece
+            if not isinstance(opponent_pawn, Pawn):
+                return
+            if pawn.square.column == 0:
+                self.add_ep(pawn, opponent_pawn, right, moves)
+            elif pawn.square.column == 7:
+                self.add_ep(pawn, opponent_pawn, left, moves)
+            else:
+                self.add_ep(pawn, opponent_pawn, right, moves)
+                self.add_ep(pawn, opponent_pawn, left, moves)
 
     def add_pawn_moves(self, pawn, moves):
         self.get_enpassant(pawn, moves)
@@ -555,7 +899,7 @@ class GameState:
                     potential_move = Move(pawn, Direction.Up, 2, self.board)
             case Color.Black:
                 if not pawn.has_moved and self.board[pawn.square.row + 1][pawn.square.column].piece is None:
-                    potential_move = Move(pawn, Direction.Up, 2, self.board)
+                    potential_move = Move(pawn, Direction.Down, 2, self.board)
         if potential_move:
             if potential_move.is_possible:
                 moves.append(potential_move)
@@ -0,0 +1,251 @@
+#
+# Texel tuning of the evaluation weights in ChessAI against game results.
+#
+# The corpus is either a PGN file of games or a text file of labelled positions, told apart by extension:
+#  - .pgn: every position reached in a game is labelled with the game's Result tag. Games start from the
+#    standard position or their FEN tag, and games without a 1-0, 0-1 or 1/2-1/2 result are skipped.
+#    A game stops being read at the first move that cannot be played, and promotions always make a queen
+#    as they do in GameState.promote_pawn.
+#  - anything else: one labelled position per line, a FEN string followed by the game result
+#    (1-0, 0-1 or 1/2-1/2), e.g. as written by most EPD exporters:
+#        rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1 c9 "1/2-1/2";
+# The corpus is streamed in chunks, so it never has to fit in memory. Features are extracted once into a
+# float32 file on disk, then every epoch streams that file back through a process pool.
+#
+# Usage: python Tuner.py corpus.pgn [--epochs 100] [--learning-rate 1.0] [--output weights.json]
+#
+import argparse
+from itertools import islice
+import json
+from multiprocessing import Pool
+import os
+import re
+
+import numpy as np
+
+try:  # bare names first, so test.py and these modules share one copy of each module
+    import Classes
+    import ChessAI
+except ImportError:  # imported as part of the Chess package from outside the Chess folder
+    from Chess import Classes, ChessAI
+
+FEATURES = ChessAI.MATERIAL_FEATURES + ChessAI.PAWN_FEATURES
+COLUMNS = len(FEATURES) + 1  # features then result
+CHUNK_SIZE = 10000
+GAMES_PER_CHUNK = 100
+SIGMOID_SCALE = 4  # a 4 pawn advantage is a 1 / (1 + 10^-1) expected score
+
+positionPattern = re.compile(r"^(?P<fen>\S+ [wb] \S+ \S+(?: \d+ \d+)?)(?=\s|$).*?(?P<result>1-0|0-1|1/2-1/2)")
+resultToScore = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+tagPattern = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$', re.MULTILINE)
+sanPattern = re.compile(r"^(?P<piece>[KQRBN])?(?P<file>[a-h])?(?P<rank>[1-8])?x?(?P<end>[a-h][1-8])(?:=?[QRBN])?$")
+castleToColumn = {"O-O": 6, "O-O-O": 2}
+
+
+def get_chunks(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_chunks(corpus_path, chunk_size=CHUNK_SIZE):
+    with open(corpus_path) as corpus_file:
+        yield from get_chunks(corpus_file, chunk_size)
+
+
+# Text of each game in a PGN file, tags and moves
+def read_games(corpus_path):
+    with open(corpus_path) as corpus_file:
+        lines = []
+        in_moves = False
+        for line in corpus_file:
+            if line.startswith("["):
+                if in_moves:
+                    yield "".join(lines)
+                    lines = []
+                    in_moves = False
+            elif line.strip():
+                in_moves = True
+            lines.append(line)
+        if in_moves:
+            yield "".join(lines)
+
+
+# Moves of a PGN game in SAN, without move numbers, comments, variations, annotations or the result
+def get_san_moves(game):
+    move_text = tagPattern.sub("", game)
+    move_text = re.sub(r"\{[^}]*\}|;[^\n]*|\$\d+", " ", move_text)
+    variation_pattern = re.compile(r"\([^()]*\)")
+    while variation_pattern.search(move_text):  # innermost variations first
+        move_text = variation_pattern.sub(" ", move_text)
+    move_text = re.sub(r"\d+\.+", " ", move_text)
+    return [token.rstrip("+#!?").replace("0", "O") for token in move_text.split()
+            if token not in resultToScore and token != "*"]
+
+
+# The valid move for the player moving written as san, or None
+def get_san_move(gs, san):
+    valid_moves = gs.get_valid_moves(gs.player_moving)
+    if san in castleToColumn:
+        for move in valid_moves:
+            if isinstance(move, Classes.Castle) and move.end_square.column == castleToColumn[san]:
+                return move
+        return None
+
+    match = sanPattern.match(san)
+    if not match:
+        return None
+    piece_letter = match.group("piece") if match.group("piece") else "p"
+    for move in valid_moves:
+        notation = move.get_chess_notation()
+        if move.piece_moving.nameAbv[1] == piece_letter and notation[2:] == match.group("end") and \
+                match.group("file") in (None, notation[0]) and match.group("rank") in (None, notation[1]) and \
+                not isinstance(move, Classes.Castle):
+            return move
+    return None
+
+
+# Feature counts, White's minus Black's, in FEATURES order
+def get_features(gs):
+    counts = ChessAI.get_pawn_structure_counts(gs)
+    for name in ChessAI.MATERIAL_FEATURES:
+        piece_class = Classes.typeToClass[Classes.PieceType[name]]
+        counts[name] = sum(isinstance(piece, piece_class) for piece in gs.players.white.piece_list) - \
+                       sum(isinstance(piece, piece_class) for piece in gs.players.black.piece_list)
+    return [counts[name] for name in FEATURES]
+
+
+# Worker: turns a chunk of corpus lines into rows of features and result. Lines without a result are skipped
+def extract_chunk(lines):
+    rows = []
+    for line in lines:
+        match = positionPattern.match(line.strip())
+        if match:
+            rows.append(get_features(Classes.GameState(match.group("fen"))) + [resultToScore[match.group("result")]])
+    return np.array(rows, dtype=np.float32).reshape(-1, COLUMNS)
+
+
+# Worker: turns a chunk of PGN games into rows of features and result, one row per position reached
+def extract_game_chunk(games):
+    rows = []
+    for game in games:
+        tags = dict(tagPattern.findall(game))
+        if tags.get("Result") not in resultToScore:
+            continue
+        gs = Classes.GameState(tags.get("FEN"))
+        for san in get_san_moves(game):
+            move = get_san_move(gs, san)
+            if move is None:
+                break
+            ChessAI.make_search_move(gs, move)
+            rows.append(get_features(gs) + [resultToScore[tags["Result"]]])
+    return np.array(rows, dtype=np.float32).reshape(-1, COLUMNS)
+
+
+def extract_features(corpus_path, features_path, processes=None, chunk_size=CHUNK_SIZE):
+    if corpus_path.endswith(".pgn"):
+        worker, chunks = extract_game_chunk, get_chunks(read_games(corpus_path), GAMES_PER_CHUNK)
+    else:
+        worker, chunks = extract_chunk, read_chunks(corpus_path, chunk_size)
+    position_count = 0
+    with Pool(processes) as pool, open(features_path, "wb") as features_file:
+        for rows in pool.imap(worker, chunks):
+            rows.tofile(features_file)
+            position_count += len(rows)
+    return position_count
+
+
+def open_features(features_path):
+    return np.memmap(features_path, dtype=np.float32, mode="r").reshape(-1, COLUMNS)
+
+
+def get_expected_scores(evaluations):
+    return 1 / (1 + np.power(10, -evaluations / SIGMOID_SCALE))
+
+
+# Worker: squared error sum and its gradient over rows [start, stop) of the features file
+def get_chunk_gradient(args):
+    features_path, start, stop, weight_vector = args
+    rows = np.asarray(open_features(features_path)[start:stop], dtype=np.float64)
+    features, results = rows[:, :-1], rows[:, -1]
+    expected_scores = get_expected_scores(features @ weight_vector)
+    errors = expected_scores - results
+    # d/dw of (sigmoid(x.w) - r)^2
+    slopes = 2 * errors * expected_scores * (1 - expected_scores) * np.log(10) / SIGMOID_SCALE
+    return np.sum(errors ** 2), features.T @ slopes
+
+
+# Squared error sum and its gradient over the whole features file, one pool task per range of rows
+def get_error_and_gradient(pool, features_path, weight_vector, ranges):
+    error = 0
+    gradient = np.zeros(len(FEATURES))
+    for chunk_error, chunk_gradient in pool.imap_unordered(get_chunk_gradient,
+                                                           [(features_path, start, stop, weight_vector) for start, stop in ranges]):
+        error += chunk_error
+        gradient += chunk_gradient
+    return error, gradient
+
+
+def get_ranges(position_count, chunk_size):
+    return [(start, min(start + chunk_size, position_count)) for start in range(0, position_count, chunk_size)]
+
+
+def count_positions(features_path):
+    position_count = len(open_features(features_path))
+    if position_count == 0:
+        raise ValueError("No labelled positions in " + features_path)
+    return position_count
+
+
+# Mean squared error of the weights' expected scores against the results
+def get_error(features_path, weights, processes=None, chunk_size=CHUNK_SIZE):
+    position_count = count_positions(features_path)
+    weight_vector = np.array([weights[name] for name in FEATURES], dtype=np.float64)
+    with Pool(processes) as pool:
+        error, gradient = get_error_and_gradient(pool, features_path, weight_vector, get_ranges(position_count, chunk_size))
+    return error / position_count
+
+
+def tune(features_path, weights, epochs=100, learning_rate=1.0, processes=None, chunk_size=CHUNK_SIZE):
+    position_count = count_positions(features_path)
+    weight_vector = np.array([weights[name] for name in FEATURES], dtype=np.float64)
+    ranges = get_ranges(position_count, chunk_size)
+
+    with Pool(processes) as pool:
+        for epoch in range(epochs):
+            error, gradient = get_error_and_gradient(pool, features_path, weight_vector, ranges)
+            weight_vector -= learning_rate * gradient / position_count
+            print("epoch " + str(epoch + 1) + ": error " + str(error / position_count))
+
+    return dict(weights, **{name: float(weight) for name, weight in zip(FEATURES, weight_vector)})
+
+
+def save_weights(weights, path=ChessAI.WEIGHTS_FILE):
+    with open(path, "w") as weights_file:
+        json.dump(weights, weights_file, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune evaluation weights on PGN games or labelled positions.")
+    parser.add_argument("corpus")
+    parser.add_argument("--features", help="where to keep extracted features, reused when it already exists")
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--learning-rate", type=float, default=1.0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--output", default=ChessAI.WEIGHTS_FILE)
+    args = parser.parse_args()
+
+    features_path = args.features if args.features else args.corpus + ".features"
+    if not os.path.exists(features_path):
+        print("extracted " + str(extract_features(args.corpus, features_path, args.processes, args.chunk_size)) + " positions")
+    weights = tune(features_path, ChessAI.load_weights(args.output), args.epochs, args.learning_rate, args.processes, args.chunk_size)
+    save_weights(weights, args.output)
+    print("wrote " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,14 @@
 # Date:
 #
 from collections import namedtuple
+import os
 
 import pygame as p
-from Chess import Classes, ChessAI
+try:  # bare names first, so test.py and these modules share one copy of each module
+    import Classes
+    import ChessAI
+except ImportError:  # imported as part of the Chess package from outside the Chess folder
+    from Chess import Classes, ChessAI
 import time
 
 WIDTH = HEIGHT = 512
@@ -16,6 +21,7 @@ DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15
 IMAGES = {}
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Images")
 
 # Sets up UI
 colors = [p.Color("white"), p.Color("grey")]
@@ -40,7 +46,7 @@ def clear_selections():
 def load_images():
     pieces = ['wp', 'wR', 'wN', 'wB', 'wK', 'wQ', 'bp', 'bR', 'bN', 'bB', 'bK', 'bQ']
     for x in pieces:
-        IMAGES[x] = p.transform.scale(p.image.load("images/" + x + ".png"), (SQ_SIZE, SQ_SIZE))
+        IMAGES[x] = p.transform.scale(p.image.load(os.path.join(IMAGES_DIR, x + ".png")), (SQ_SIZE, SQ_SIZE))
 
 
 def main():
@@ -56,7 +62,7 @@ def main():
     player_black_is_human = True
     is_running = True
     gs = Classes.GameState()
-    valid_moves = gs.get_valid_moves(gs.player_moving)
+    valid_moves = gs.get_cached_valid_moves()
     move_made = animate = game_over = False  # flags
     square_selected = None
     print("\n------ " + gs.player_moving.color.name + "'s Turn! ------\n")
@@ -88,21 +94,11 @@ def main():
                                 selected_squares.end_square = square_selected
 
                         if selected_squares.start_square and selected_squares.end_square:  # Two squares selected
-                            '''
-                            move = Classes.Move(selected_squares[0], selected_squares[1])
-                            if move in valid_moves:
-                                the_move = valid_moves[valid_moves.index(move)]  # TODO fix castling error
-                                '''
-                            the_move = None
-                            for move in valid_moves:
-                                if move == selected_squares:
-                                    the_move = move
-                                    break
+                            the_move = valid_moves.get_move(selected_squares.start_square, selected_squares.end_square)
 
                             if the_move:
                                 gs.make_move(the_move)
                                 animate = move_made = True
-                                the_move.piece_moving.has_moved = True
                                 if gs.can_promote_pawn(the_move):  # handles pawn promotion
                                     draw_game_state(screen, gs, valid_moves, square_selected)
                                     clock.tick(MAX_FPS)
@@ -119,12 +115,13 @@ def main():
                     is_running = False
                 elif e.type == p.KEYDOWN:
                     if e.key == p.K_z:
-                        gs.undo_move()
-                        animate = False
-                        move_made = True
+                        if gs.undo_turn():  # already gives the turn back, so no move_made toggle
+                            valid_moves = gs.get_cached_valid_moves()
+                            clear_selections()
+                            square_selected = None
                     elif e.key == p.K_r:
                         gs = Classes.GameState()
-                        valid_moves = gs.get_valid_moves(gs.player_moving)
+                        valid_moves = gs.get_cached_valid_moves()
                         clear_selections()
                         square_selected = None
                         move_made = animate = False
@@ -135,7 +132,7 @@ def main():
             # time.sleep(1)
             gs.make_move(ai_move)
             # animate = True
-            move_made = ai_move.piece_moving.has_moved = True
+            move_made = True
             if gs.can_promote_pawn(ai_move):
                 draw_game_state(screen, gs, valid_moves, square_selected)
                 clock.tick(MAX_FPS)
@@ -147,9 +144,9 @@ def main():
             if animate:
                 animate_move(gs.moveLog[-1], screen, gs.board, clock)
             gs.toggle_turn()
-            valid_moves = gs.get_valid_moves(gs.player_moving)
+            valid_moves = gs.get_cached_valid_moves()
             print("===========================\n")
-            if len(valid_moves) == 0:
+            if len(valid_moves) == 0 or gs.is_threefold_repetition() or gs.is_fifty_move_draw():
                 game_over = True
             else:
                 print("------ " + gs.player_moving.color.name + "'s Turn! ------\n")
@@ -158,18 +155,24 @@ def main():
             move_made = False
 
         # update gui
-        if not gs.checkmate and not gs.stalemate:
+        if not gs.checkmate and not gs.stalemate and not gs.draw:
             draw_game_state(screen, gs, valid_moves, square_selected)
             clock.tick(MAX_FPS)
             p.display.flip()
 
             if game_over:
-                if gs.player_moving.is_in_check(gs.board):
+                if len(valid_moves) == 0 and gs.player_moving.is_in_check(gs.board):
                     gs.checkmate = True
                     draw_text(screen, gs.player_waiting.color.name + " wins by Checkmate!")
-                else:
+                elif len(valid_moves) == 0:
                     gs.stalemate = True
                     draw_text(screen, "Stalemate!")
+                elif gs.is_threefold_repetition():
+                    gs.draw = True
+                    draw_text(screen, "Draw by Repetition!")
+                else:
+                    gs.draw = True
+                    draw_text(screen, "Draw by Fifty-Move Rule!")
 
 
 def animate_move(move, screen, board, clock):
@@ -1,5 +1,21 @@
+import os
+import tempfile
 import unittest
-from Classes import get_rank_file
+from Classes import get_rank_file, get_row_column, GameState, MoveCache, ValidMoves, EnPassant, SNAPSHOT_FORMAT
+import Classes
+import ChessAI
+import Benchmark
+
+try:
+    import Tuner
+except ImportError:  # numpy is only needed for tuning
+    Tuner = None
+
+
+def get_move(gs, notation):
+    for move in gs.get_valid_moves(gs.player_moving):
+        if move.get_chess_notation() == notation:
+            return move
 
 
 class MyTestCase(unittest.TestCase):
@@ -10,6 +26,282 @@ class MyTestCase(unittest.TestCase):
         result = get_rank_file(1, 0)
         self.assertEqual(result, "a7")
 
+    def test_get_row_column(self):
+        self.assertEqual(get_row_column("a8"), (0, 0))
+        self.assertEqual(get_row_column("e2"), (6, 4))
+
+    def test_modules_share_classes(self):
+        self.assertIs(ChessAI.Classes, Classes)
+        self.assertIs(Benchmark.Classes, Classes)
+        if Tuner is not None:
+            self.assertIs(Tuner.Classes, Classes)
+
+
+class GameStateTestCase(unittest.TestCase):
+    def test_generate_valid_moves_matches_get_valid_moves(self):
+        gs = GameState("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+        generated = sorted(move.get_chess_notation() for move in gs.generate_valid_moves(gs.player_moving))
+        self.assertEqual(generated, sorted(move.get_chess_notation() for move in gs.get_valid_moves(gs.player_moving)))
+        self.assertEqual(len(generated), 48)
+
+    def test_has_legal_move(self):
+        self.assertTrue(GameState().has_legal_move(GameState().player_moving))
+
+        gs = GameState("r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4")  # checkmate
+        self.assertFalse(gs.has_legal_move(gs.player_moving))
+
+        gs = GameState("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1")  # stalemate
+        self.assertFalse(gs.has_legal_move(gs.player_moving))
+        self.assertFalse(gs.player_moving.is_in_check(gs.board))
+
+    def test_cached_valid_moves(self):
+        gs = GameState()
+        valid_moves = gs.get_cached_valid_moves()
+        start_square = gs.board[6][4]
+        end_square = gs.board[4][4]
+        move = valid_moves.get_move(start_square, end_square)
+        self.assertEqual(move.get_chess_notation(), "e2e4")
+        self.assertIsNone(valid_moves.get_move(end_square, start_square))
+
+        gs.make_move(move)
+        gs.toggle_turn()
+        self.assertNotEqual(gs.get_cached_valid_moves(), valid_moves)
+        gs.toggle_turn()
+        gs.undo_move()
+        self.assertIs(gs.get_cached_valid_moves(), valid_moves)
+        self.assertEqual((gs.move_cache.hits, gs.move_cache.misses), (1, 2))
+
+    def test_move_cache_evicts_least_recently_used(self):
+        move_cache = MoveCache(2)
+        for key in range(3):
+            move_cache.put(key, ValidMoves([]))
+            move_cache.get(0)
+        self.assertEqual(list(move_cache.entries), [2, 0])
+
+    def test_snapshot_round_trip(self):
+        gs = GameState("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w Kq - 0 1")
+        gs.make_move(get_move(gs, "a2a4"))
+        gs.toggle_turn()
+        snapshot = gs.snapshot()
+        self.assertEqual(len(snapshot), SNAPSHOT_FORMAT.size)
+        self.assertEqual(SNAPSHOT_FORMAT.size, 71)
+        self.assertEqual(snapshot[-4:], (1).to_bytes(2, "little") + (0).to_bytes(2, "little"))  # ply, halfmove clock
+
+        clone = gs.clone()
+        self.assertEqual(clone.snapshot(), snapshot)
+        self.assertEqual(clone.get_position_hash(), gs.get_position_hash())
+        self.assertEqual(len(clone.moveLog), 0)
+        self.assertEqual(clone.get_ply(), 1)
+        self.assertEqual(sorted(move.get_chess_notation() for move in clone.get_valid_moves(clone.player_moving)),
+                         sorted(move.get_chess_notation() for move in gs.get_valid_moves(gs.player_moving)))
+        self.assertIn("b4a3", [move.get_chess_notation() for move in clone.get_valid_moves(clone.player_moving)])
+
+        clone.make_move(get_move(clone, "a8b8"))
+        self.assertEqual(gs.snapshot(), snapshot)
+
+        clone.checkmate = clone.draw = True
+        clone.restore(snapshot)  # in place, over a finished game
+        self.assertFalse(clone.checkmate or clone.stalemate or clone.draw)
+        self.assertEqual(clone.snapshot(), snapshot)
+
+    def test_fen_en_passant(self):
+        gs = GameState("rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3")
+        en_passant_moves = [move for move in gs.get_valid_moves(gs.player_moving) if isinstance(move, EnPassant)]
+        self.assertEqual([move.get_chess_notation() for move in en_passant_moves], ["e5f6"])
+
+    def test_threefold_repetition(self):
+        gs = GameState()
+        for notation in ["g1f3", "g8f6", "f3g1", "f6g8"] * 2:
+            self.assertFalse(gs.is_threefold_repetition())
+            gs.make_move(get_move(gs, notation))
+            gs.toggle_turn()
+        self.assertTrue(gs.is_threefold_repetition())
+        self.assertEqual(gs.hash_history[-1], gs.get_position_hash())
+
+        gs.toggle_turn()
+        gs.undo_move()
+        self.assertFalse(gs.is_threefold_repetition())
+
+    def test_undo_turn(self):
+        gs = GameState()
+        for notation in ["e2e4", "d7d5", "e4d5"]:
+            gs.make_move(get_move(gs, notation))
+            gs.toggle_turn()
+        self.assertTrue(gs.undo_turn())  # the captured pawn goes back to Black
+
+        self.assertEqual(gs.player_moving.color.name, "White")
+        self.assertEqual(sum(piece.nameAbv == "bp" for piece in gs.players.black.piece_list), 8)
+        self.assertTrue(all(piece.color.name == "White" for piece in gs.players.white.piece_list))
+        gs.make_move(get_move(gs, "e4d5"))  # capturing the same pawn again
+        gs.toggle_turn()
+        self.assertEqual(sum(piece.nameAbv == "bp" for piece in gs.players.black.piece_list), 7)
+
+    def test_undo_turn_past_start_of_game(self):
+        gs = GameState()
+        gs.make_move(get_move(gs, "e2e4"))
+        gs.toggle_turn()
+        self.assertTrue(gs.undo_turn())
+        self.assertFalse(gs.undo_turn())  # nothing left to undo, and the turn stays with White
+
+        self.assertEqual(gs.player_moving.color.name, "White")
+        self.assertEqual(gs.hash_history, [gs.get_position_hash()])
+        self.assertEqual(gs.halfmove_clocks, [0])
+        valid_moves = gs.get_cached_valid_moves()
+        self.assertEqual(len(valid_moves), 20)
+        self.assertTrue(all(move.piece_moving.color == gs.player_moving.color for move in valid_moves))
+
+    def test_fifty_move_rule(self):
+        gs = GameState("4k3/8/8/8/8/8/4P3/4K3 w - - 99 80")
+        gs.make_move(get_move(gs, "e1d1"))
+        self.assertTrue(gs.is_fifty_move_draw())
+        gs.undo_move()
+        gs.make_move(get_move(gs, "e2e4"))
+        self.assertFalse(gs.is_fifty_move_draw())
+        self.assertEqual(gs.halfmove_clocks[-1], 0)
+        gs.undo_move()
+        self.assertFalse(gs.board[6][4].piece.has_moved)
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.weights = ChessAI.weights
+        ChessAI.set_weights(dict(ChessAI.DEFAULT_WEIGHTS))
+
+    def tearDown(self):
+        ChessAI.set_weights(self.weights)
+
+    def test_static_exchange_evaluation(self):
+        gs = GameState("1k1r4/1pp4p/p7/4p3/8/P5P1/1PP4P/2K1R3 w - - 0 1")
+        self.assertEqual(ChessAI.static_exchange_evaluation(gs, get_move(gs, "e1e5")), 1)
+
+        # x-ray: the rook behind the queen joins the exchange
+        gs = GameState("1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1")
+        self.assertEqual(ChessAI.static_exchange_evaluation(gs, get_move(gs, "d3e5")), -2)
+
+    def test_quiescence_skips_losing_captures(self):
+        gs = GameState("4k3/2p5/3p4/8/8/8/3R4/3RK3 w - - 0 1")
+        pruned_stats = ChessAI.SearchStats()
+        full_stats = ChessAI.SearchStats()
+        # two rooks against two passed pawns
+        self.assertEqual(ChessAI.quiescence(gs, -ChessAI.MATE_SCORE, ChessAI.MATE_SCORE, pruned_stats), 7)
+        self.assertEqual(ChessAI.quiescence(gs, -ChessAI.MATE_SCORE, ChessAI.MATE_SCORE, full_stats, False), 7)
+        self.assertLess(pruned_stats.quiescence_nodes, full_stats.quiescence_nodes)
+        self.assertEqual(len(gs.moveLog), 0)
+
+        gs = GameState("4k3/8/3p4/8/8/8/3R4/4K3 w - - 0 1")
+        self.assertEqual(ChessAI.quiescence(gs, -ChessAI.MATE_SCORE, ChessAI.MATE_SCORE, ChessAI.SearchStats()), 5)
+
+    def test_negamax_scores_repetition_as_draw(self):
+        gs = GameState("4k3/8/8/8/8/8/Q7/4K3 w - - 0 1")
+        stats = ChessAI.SearchStats()
+        self.assertEqual(ChessAI.negamax(gs, 1, -ChessAI.MATE_SCORE, ChessAI.MATE_SCORE, stats), 9)
+        for notation in ["a2a1", "e8d7", "a1a2", "d7e8"]:
+            gs.make_move(get_move(gs, notation))
+            gs.toggle_turn()
+        self.assertEqual(ChessAI.negamax(gs, 1, -ChessAI.MATE_SCORE, ChessAI.MATE_SCORE, stats), 0)
+
+    def test_evaluate_pawn_structure(self):
+        self.assertEqual(ChessAI.evaluate_pawn_structure(GameState()), 0)
+
+        # white: doubled and isolated e-pawns, black: passed a-pawn
+        gs = GameState("4k3/p7/8/8/4P3/4P3/8/4K3 w - - 0 1")
+        self.assertEqual(ChessAI.get_pawn_structure_counts(gs), {"doubled_pawn": 1, "isolated_pawn": 1, "passed_pawn": 1})
+        self.assertEqual(ChessAI.evaluate_pawn_structure(gs), -0.25 - 0.25 + 0.5)
+
+    def test_load_weights(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "weights.json")
+            self.assertEqual(ChessAI.load_weights(path), ChessAI.DEFAULT_WEIGHTS)
+            with open(path, "w") as weights_file:
+                weights_file.write('{"Pawn": 1.5}')
+            ChessAI.set_weights(ChessAI.load_weights(path))
+        self.assertEqual(ChessAI.weights["Queen"], ChessAI.DEFAULT_WEIGHTS["Queen"])
+        self.assertEqual(ChessAI.evaluate(GameState("4k3/8/8/8/8/8/PP6/4K3 w - - 0 1")), 2 * 1.5 + 2 * 0.5)  # two passed pawns
+
+    def test_pawn_hash_table(self):
+        gs = GameState()
+        pawn_table = ChessAI.PawnHashTable(64)
+        pawn_table.get_score(gs)
+        pawn_hash = gs.pawn_hash_history[-1]
+
+        gs.make_move(get_move(gs, "g1f3"))
+        self.assertEqual(gs.pawn_hash_history[-1], pawn_hash)
+        pawn_table.get_score(gs)
+        self.assertEqual((pawn_table.hits, pawn_table.misses), (1, 1))
+
+        gs.toggle_turn()
+        gs.make_move(get_move(gs, "e7e5"))
+        self.assertNotEqual(gs.pawn_hash_history[-1], pawn_hash)
+        self.assertEqual(gs.pawn_hash_history[-1], gs.get_pawn_hash())
+        pawn_table.get_score(gs)
+        self.assertEqual(pawn_table.get_hit_rate(), 1 / 3)
+
+    def test_get_best_move_finds_mate(self):
+        gs = GameState("r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4")
+        move, score = ChessAI.get_best_move(gs, 2)
+        self.assertEqual(move.get_chess_notation(), "h5f7")
+        self.assertEqual(score, ChessAI.MATE_SCORE - 1)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_get_regressions(self):
+        baseline = {"perft": {"value": 1000, "unit": "nodes/s", "higher_is_better": True},
+                    "game_state": {"value": 200, "unit": "us", "higher_is_better": False}}
+        results = {"perft": {"value": 800, "unit": "nodes/s", "higher_is_better": True},
+                   "game_state": {"value": 220, "unit": "us", "higher_is_better": False},
+                   "render": {"value": 3, "unit": "ms", "higher_is_better": False}}
+        self.assertEqual(Benchmark.get_regressions(baseline, results, 0.15), {"perft": 0.2})
+        self.assertEqual(Benchmark.get_regressions(baseline, results, 0.05), {"perft": 0.2, "game_state": 0.1})
+
+    def test_perft(self):
+        self.assertEqual(Benchmark.perft(GameState(), 2), 400)
+
+    def test_copy_sizes(self):
+        self.assertEqual(Benchmark.bench_snapshot_size().value, SNAPSHOT_FORMAT.size)
+        self.assertLess(Benchmark.bench_snapshot_size().value, Benchmark.bench_pickle_size().value)
+
+
+@unittest.skipIf(Tuner is None, "numpy is not installed")
+class TunerTestCase(unittest.TestCase):
+    def test_extract_chunk(self):
+        rows = Tuner.extract_chunk(['4k3/8/8/8/8/8/PP6/4K3 w - - 0 1 c9 "1-0";\n',
+                                    "not a position\n",
+                                    "4k3/q7/8/8/8/8/8/4K3 b - - 1/2-1/2\n"])
+        self.assertEqual(rows.tolist(), [[0, 0, 0, 0, 2, 0, 0, 2, 1.0],
+                                         [-1, 0, 0, 0, 0, 0, 0, 0, 0.5]])
+
+    def test_extract_game_chunk(self):
+        games = ['[Event "Italian"]\n[Result "1-0"]\n\n1. e4 e5 2. Nf3 {develops} Nc6 (2... d6 3. d4) 3. Bc4 Nf6\n4. O-O Nxe4 5. Re1 1-0\n',
+                 '[Result "0-1"]\n\n1. f3 e5 2. g4 $4 Qh4# 0-1\n',
+                 '[Result "*"]\n\n1. e4 *\n',
+                 '[FEN "4k3/P7/8/8/8/8/8/4K3 w - - 0 1"]\n[Result "1/2-1/2"]\n\n1. a8=Q+ Kd7 2. Kf9 1/2-1/2\n']
+        rows = Tuner.extract_game_chunk(games).tolist()
+        self.assertEqual(len(rows), 9 + 4 + 2)  # the last game stops at its illegal move
+        self.assertEqual(rows[8], [0, 0, 0, 0, -1, 0, 0, 0, 1.0])  # after Nxe4 and Re1
+        self.assertEqual([row[-1] for row in rows[9:13]], [0.0] * 4)
+        self.assertEqual(rows[13], [1, 0, 0, 0, 0, 0, 0, 0, 0.5])
+
+    def test_read_games(self):
+        with tempfile.TemporaryDirectory() as directory:
+            corpus_path = os.path.join(directory, "corpus.pgn")
+            with open(corpus_path, "w") as corpus_file:
+                corpus_file.write('[Result "1-0"]\n\n1. e4 1-0\n\n[Result "0-1"]\n[White "b"]\n\n1. d4\n0-1\n')
+            self.assertEqual(list(Tuner.read_games(corpus_path)),
+                             ['[Result "1-0"]\n\n1. e4 1-0\n\n', '[Result "0-1"]\n[White "b"]\n\n1. d4\n0-1\n'])
+
+    def test_tune_reduces_error(self):
+        lines = ['4k3/8/8/8/8/8/PP6/4K3 w - - 0 1 "1-0"\n', '4k3/pp6/8/8/8/8/8/4K3 w - - 0 1 "0-1"\n'] * 10
+        with tempfile.TemporaryDirectory() as directory:
+            corpus_path = os.path.join(directory, "corpus.epd")
+            features_path = os.path.join(directory, "corpus.features")
+            with open(corpus_path, "w") as corpus_file:
+                corpus_file.writelines(lines)
+            self.assertEqual(Tuner.extract_features(corpus_path, features_path, 2, 7), 20)
+
+            weights = Tuner.tune(features_path, ChessAI.DEFAULT_WEIGHTS, epochs=5, learning_rate=10, processes=2, chunk_size=7)
+            self.assertLess(Tuner.get_error(features_path, weights, 2, 7), Tuner.get_error(features_path, ChessAI.DEFAULT_WEIGHTS, 2, 7))
+        self.assertGreater(weights["Pawn"] + weights["passed_pawn"], ChessAI.DEFAULT_WEIGHTS["Pawn"] + ChessAI.DEFAULT_WEIGHTS["passed_pawn"])
+        self.assertEqual(weights["Queen"], ChessAI.DEFAULT_WEIGHTS["Queen"])
 
 if __name__ == '__main__':
     unittest.main()